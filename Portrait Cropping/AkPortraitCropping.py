@@ -1,29 +1,164 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 __author__ = 'aelurum'
-__version__ = '0.7b'
+__version__ = '0.8b'
 
+import argparse
+import concurrent.futures
 import json
 import os
+import shutil
+import subprocess
 import sys
+import threading
 import traceback
 from collections import defaultdict
 from datetime import datetime
 from enum import Enum, auto
+from io import BytesIO
 from multiprocessing import Pool
 
 try:
-    from PIL import Image
+    import PIL
+    from PIL import Image, features
 except ModuleNotFoundError:
     sys.exit('Pillow library was not found.\n'
              'Please install it using "python3 -m pip install --upgrade Pillow"')
 
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    sys.exit('NumPy library was not found.\n'
+             'Please install it using "python3 -m pip install --upgrade numpy"')
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+try:
+    import cv2
+except ModuleNotFoundError:
+    cv2 = None
+
 
 class ImageFormat(Enum):
     PNG = auto()
     WEBP = auto()
 
 
+class Compression(Enum):
+    FAST = auto()
+    DEFAULT = auto()
+    SMALL = auto()
+
+
+def get_pillow_backend() -> str:
+    """Return the name and version of the installed Pillow build and of the zlib library used by it.
+
+    Pillow-SIMD is a drop-in fork of Pillow and can only be distinguished by its version suffix (e.g. "9.0.0.post1").
+    zlib version is reported at runtime, so a zlib replacement loaded via LD_PRELOAD (e.g. "1.3.0.zlib-ng") is shown.
+    """
+    backend = 'Pillow-SIMD' if 'post' in PIL.__version__ else 'Pillow'
+    return f'{backend} {PIL.__version__} (zlib {features.version_codec("zlib")})'
+
+
+def get_cpu_count() -> int:
+    """Return the number of CPUs this process is allowed to run on (e.g. when limited by a container)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_save_options(img_format: ImageFormat, compression: Compression, lossy: bool = False) -> dict:
+    """Return keyword arguments for `Image.save()` for the specified output format and compression mode."""
+    save_options = {'format': img_format.name}
+    if img_format == ImageFormat.PNG:
+        # Fast deflate, small files are left to the oxipng post-pass (if it's available)
+        small_fallback = compression == Compression.SMALL and not shutil.which('oxipng')
+        save_options['compress_level'] = 9 if small_fallback else 1
+    elif img_format == ImageFormat.WEBP:
+        # Encoder effort: 0 - fastest, 6 - smallest files
+        method = {Compression.FAST: 0, Compression.DEFAULT: 4, Compression.SMALL: 6}[compression]
+        if lossy:
+            save_options.update({'lossless': False, 'method': method})
+            if compression == Compression.FAST:
+                save_options['quality'] = 85  # compensates for the size regression of the fastest method
+        else:
+            # In lossless mode quality is the compression effort. Maximum effort costs about twice the encoding time
+            # of 75 for ~3% smaller files, so it's used only on request. exact=True keeps RGB values of fully
+            # transparent pixels
+            effort = {Compression.FAST: 50, Compression.DEFAULT: 75, Compression.SMALL: 100}[compression]
+            save_options.update({'lossless': True, 'method': method, 'quality': effort, 'exact': True})
+    return save_options
+
+
+def optimize_png_output(out_dir: str) -> bool:
+    """Recompress PNG portraits in the specified folder using oxipng and return `False` if oxipng was not found."""
+    oxipng_path = shutil.which('oxipng')
+    if not oxipng_path:
+        return False
+
+    print('Optimizing portraits with oxipng..')
+    subprocess.run(
+        [oxipng_path, '--opt', '2', '--threads', str(get_cpu_count()), '--strip', 'safe', '--quiet',
+         '--recursive', out_dir],
+        check=True
+    )
+    return True
+
+
+_thread_buffers = threading.local()
+
+
+def get_image_saver(save_options: dict, dir_fd: int = None):
+    """Return a `save(image_np, path)` function that encodes an RGBA image array and writes it to the file.
+
+    Relative paths are resolved against the `dir_fd` directory descriptor, if it's specified.
+
+    The encoder is chosen once here instead of for every image. PNG images are encoded by OpenCV if it's installed,
+    other images are encoded by Pillow into a reusable per-thread buffer.
+    `save_options` must contain the image format, since it can't be guessed from a buffer.
+    """
+    if cv2 and save_options['format'] == 'PNG':
+        cv2_params = [cv2.IMWRITE_PNG_COMPRESSION, save_options['compress_level']]
+
+        def save(image_np: np.ndarray, path: str):
+            _, data = cv2.imencode('.png', cv2.cvtColor(image_np, cv2.COLOR_RGBA2BGRA), cv2_params)
+            _write_file(path, data.ravel(), dir_fd)
+    else:
+        def save(image_np: np.ndarray, path: str):
+            buffer = getattr(_thread_buffers, 'encode', None)
+            if buffer is None:
+                buffer = _thread_buffers.encode = BytesIO()
+            buffer.seek(0)
+            buffer.truncate()
+            Image.fromarray(image_np).save(buffer, **save_options)
+            with buffer.getbuffer() as data:
+                _write_file(path, data, dir_fd)
+
+    return save
+
+
+def _write_file(path: str, data, dir_fd: int = None):
+    """Write the bytes-like object to the file, replacing its contents."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666, dir_fd=dir_fd)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    finally:
+        os.close(fd)
+
+
+def load_json(path: str):
+    """Load the json file, using the faster orjson library if it's installed."""
+    with open(path, 'rb') as json_file:
+        if orjson:
+            return orjson.loads(json_file.read())
+        return json.load(json_file)
+
+
 def validate_json_atlas(atlas_json: dict, atlas_path: str):
     """Check that the atlas json file meets required conditions and raise NotImplementedError if the check fails."""
     keys = ('_sprites', '_index', '_sign')
@@ -65,22 +200,9 @@ def load_portrait_hub(json_dir: str, hub_name: str) -> dict:
             {
                 "atlas_name": str,
                 "alpha_name": str,
-                "sprites": list[dict]
-                [
-                    {
-                        "name": str,
-                        "guid": str,
-                        "atlas": int,
-                        "rect": dict[str, int]
-                        {
-                            "x": int,
-                            "y": int,
-                            "w": int,
-                            "h": int
-                        },
-                        "rotate": int  # 0 or 1
-                    },
-                ]
+                "sprite_names": list[str],
+                "sprite_rects": np.ndarray,  # int32, shape (sprite_count, 4): x, y, w, h
+                "sprite_rotates": np.ndarray  # int32, shape (sprite_count,): 0 or 1
             },
         ]
     }
@@ -96,8 +218,7 @@ def load_portrait_hub(json_dir: str, hub_name: str) -> dict:
     if not os.path.exists(portrait_hub_path):
         sys.exit(f'[Error] "portrait_hub.json" was not found in this path: "{portrait_hub_path}"')
 
-    with open(portrait_hub_path, "rb") as hub_data:
-        json_hub = json.load(hub_data)
+    json_hub = load_json(portrait_hub_path)
 
     sprite_list = json_hub['_sprites']  # list[dict]
     hub['sprite_count'] = len(sprite_list)
@@ -118,8 +239,7 @@ def load_portrait_hub(json_dir: str, hub_name: str) -> dict:
     loaded_atlas_count = 0
     for atlas_path in atlas_path_list:
         try:
-            with open(atlas_path, "rb") as atlas_data:
-                json_atlas = json.load(atlas_data)
+            json_atlas = load_json(atlas_path)
 
             validate_json_atlas(json_atlas, atlas_path)
             sprite_list = json_atlas['_sprites']
@@ -129,11 +249,21 @@ def load_portrait_hub(json_dir: str, hub_name: str) -> dict:
                 for sprite in sprite_list
                 if sprite['name'] in atlas_dict[atlas_index]
             ]
+            # Sprites are ordered tile by tile (256x256 px), so that consecutive crops read nearby atlas memory
+            filtered_sprite_list.sort(key=lambda x: (x['rect']['y'] >> 8, x['rect']['x'] >> 8))
+            # Sprite data is stored as columns, so that it can be passed to the crop kernel as is
             hub['atlases'].append(
                 {
                     'atlas_name': json_atlas['_sign']['m_atlases'][0]['name'],
                     'alpha_name': json_atlas['_sign']['m_alphas'][0]['name'],
-                    'sprites': filtered_sprite_list,
+                    'sprite_names': [sprite['name'] for sprite in filtered_sprite_list],
+                    'sprite_rects': np.array(
+                        [tuple(sprite['rect'][key] for key in 'xywh') for sprite in filtered_sprite_list],
+                        dtype=np.int32
+                    ).reshape(-1, 4),
+                    'sprite_rotates': np.array(
+                        [sprite['rotate'] for sprite in filtered_sprite_list], dtype=np.int32
+                    ),
                 }
             )
             loaded_sprite_count += len(filtered_sprite_list)
@@ -150,7 +280,8 @@ def load_portrait_hub(json_dir: str, hub_name: str) -> dict:
     return hub
 
 
-def crop_multiprocessing(tex_dir: str, out_dir: str, img_format: ImageFormat, hub: dict) -> int:
+def crop_multiprocessing(tex_dir: str, out_dir: str, img_format: ImageFormat, hub: dict,
+                         compression: Compression = Compression.DEFAULT, lossy: bool = False) -> int:
     """Crop sprites using multiprocessing and return total number of processed sprites.
 
     Parameters
@@ -163,29 +294,46 @@ def crop_multiprocessing(tex_dir: str, out_dir: str, img_format: ImageFormat, hu
         Format of the output portrait images (.png/.webp).
     hub : dict
         Custom hub dictionary.
+    compression : Compression
+        Compression mode of the output portrait images.
+    lossy : bool
+        Use lossy compression (.webp only).
     """
-    if not os.path.exists(out_dir):
-        os.makedirs(out_dir)
-
+    os.makedirs(out_dir, exist_ok=True)
+
+    save_options = get_save_options(img_format, compression, lossy)
+    # Largest atlases go first, so that workers don't wait for a single big atlas at the end
+    atlases = sorted(hub['atlases'], key=lambda x: len(x['sprite_names']), reverse=True)
+    # PNG and WebP encoding are both CPU-bound, so there is no point in more workers (and their encoder threads)
+    # than CPUs
+    cpu_count = get_cpu_count()
+    processes = max(min(cpu_count, len(atlases)), 1)
+    encoder_threads = max(cpu_count // processes, 1)
     args = (
-        (atlas, img_format, hub['sprite_size'], tex_dir, out_dir)
-        for atlas in hub['atlases']
+        (atlas, img_format, save_options, hub['sprite_size'], tex_dir, out_dir, encoder_threads)
+        for atlas in atlases
     )
-    with Pool(processes=os.cpu_count()) as pool:
-        proc_count = sum(pool.map(_crop, args))
+    with Pool(processes=processes) as pool:
+        proc_count = 0
+        # Progress is printed by the main process only, so that workers don't compete for stdout
+        for atlas_name, atlas_proc_count in pool.imap_unordered(_crop, args, chunksize=1):
+            print(f'Processed "{atlas_name}" atlas.')
+            proc_count += atlas_proc_count
 
     return proc_count
 
 
-def _crop(args_tuple: tuple) -> int:
-    """Crop sprites from specified atlas and return processed sprite count."""
+def _crop(args_tuple: tuple) -> tuple:
+    """Crop sprites from specified atlas and return its name and processed sprite count."""
     atlas: dict
     img_format: ImageFormat
+    save_options: dict
     sprite_size: tuple
     tex_dir: str
     out_dir: str
-    if args_tuple and isinstance(args_tuple, tuple) and len(args_tuple) == 5:
-        atlas, img_format, sprite_size, tex_dir, out_dir = args_tuple
+    encoder_threads: int
+    if args_tuple and isinstance(args_tuple, tuple) and len(args_tuple) == 7:
+        atlas, img_format, save_options, sprite_size, tex_dir, out_dir, encoder_threads = args_tuple
     else:
         arg_error = f'{"args type" if not isinstance(args_tuple, tuple) else "args length"}'
         sys.exit(f'_crop(): [Error] Incorrect {arg_error}.')
@@ -193,63 +341,121 @@ def _crop(args_tuple: tuple) -> int:
     atlas_path = os.path.join(tex_dir, f'{atlas["atlas_name"]}.png')
     alpha_path = os.path.join(tex_dir, f'{atlas["alpha_name"]}.png')
 
-    atlas_tex = Image.open(atlas_path)
-    with Image.open(alpha_path) as atlas_alpha:
-        atlas_alpha = atlas_alpha.convert(mode='L')
-        if atlas_alpha.size != atlas_tex.size:
-            atlas_alpha = atlas_alpha.resize(size=atlas_tex.size, resample=Image.BICUBIC)
-        atlas_tex.putalpha(atlas_alpha)
+    with Image.open(atlas_path) as atlas_tex, Image.open(alpha_path) as atlas_alpha:
+        # Conversions are skipped for images that are already in a suitable mode
+        if atlas_alpha.mode != 'L':
+            atlas_alpha = atlas_alpha.convert(mode='L')
+        alpha_factor = atlas_alpha.width // atlas_tex.width
+        if alpha_factor > 1 and atlas_alpha.size == (atlas_tex.width * alpha_factor, atlas_tex.height * alpha_factor):
+            # Integer downscale, box filter of reduce() is much cheaper than a resampling convolution
+            atlas_alpha = atlas_alpha.reduce(alpha_factor)
+        elif atlas_alpha.size != atlas_tex.size:
+            # Bicubic filter gives no visible benefit on a mask
+            atlas_alpha = atlas_alpha.resize(size=atlas_tex.size, resample=Image.BILINEAR)
+        if atlas_tex.mode not in ('RGB', 'RGBA'):
+            atlas_tex = atlas_tex.convert(mode='RGB')
+        # RGB + alpha channels in one (height, width, 4) array, filled in place to avoid intermediate copies
+        atlas_np = np.empty((atlas_tex.height, atlas_tex.width, 4), dtype=np.uint8)
+        atlas_np[:, :, :3] = np.asarray(atlas_tex)[:, :, :3]
+        atlas_np[:, :, 3] = np.asarray(atlas_alpha)
+        # Converted images are new objects, which are not closed by the with statement
+        atlas_alpha.close()
+        atlas_tex.close()
+
+    portraits = _get_portrait_buffer(len(atlas['sprite_names']), sprite_size[1], sprite_size[0])
+    _extract_sprites(atlas_np, atlas['sprite_rects'], atlas['sprite_rotates'], portraits)
 
     proc_count = 0
-    for sprite in atlas['sprites']:
-        sprite_name = sprite['name']
-        rect = sprite['rect']
-        rotate = sprite['rotate']
-
-        # Uses flipped Y coord
-        portrait = atlas_tex.crop(
-            box=(
-                rect['x'],  # x
-                atlas_tex.height - (rect['y'] + rect['h']),  # y
-                rect['x'] + rect['w'],  # width
-                atlas_tex.height - rect['y']  # height
-            )
-        )
-        if rotate:
-            portrait = portrait.transpose(method=Image.ROTATE_270)
-        if rect['w'] not in sprite_size or rect['h'] not in sprite_size:  # size fix (just in case)
-            temp = Image.new(mode='RGBA', size=sprite_size, color=(1, 1, 1, 0))
-            temp.alpha_composite(
-                im=portrait,
-                dest=(
-                    max(sprite_size[0] - portrait.width, 0),
-                    max(sprite_size[1] - portrait.height, 0)
-                )
-            )
-            portrait = temp
-
-        output_path = os.path.join(out_dir, f'{sprite_name}.{img_format.name.lower()}')
-        save_options = {'format': img_format.name}
-        if img_format == ImageFormat.PNG:
-            save_options['compress_level'] = 7
-        elif img_format == ImageFormat.WEBP:
-            save_options['lossless'] = False
-        portrait.save(output_path, **save_options)
-        proc_count += 1
-    atlas_tex.close()
-    print(f'Processed "{atlas["atlas_name"]}" atlas.\n', end='')  # fix for "parallel" processing
+    ext = f'.{img_format.name.lower()}'
+    # Where supported (posix), files are created relative to the opened output folder,
+    # so that the folder path isn't resolved again for every file
+    if os.open in os.supports_dir_fd:
+        dir_fd = os.open(out_dir, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        out_prefix = ''
+    else:
+        dir_fd = None
+        out_prefix = os.path.join(out_dir, '')
+    save_image = get_image_saver(save_options, dir_fd)
+    try:
+        # Images are encoded and saved by a thread pool (encoders release the GIL)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=encoder_threads) as encoder:
+            futures = [
+                encoder.submit(save_image, portrait_np, out_prefix + sprite_name + ext)
+                for sprite_name, portrait_np in zip(atlas['sprite_names'], portraits)
+            ]
+            for future in futures:
+                future.result()
+                proc_count += 1
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
 
-    return proc_count
+    return atlas['atlas_name'], proc_count
 
 
-if __name__ == '__main__':
-    image_format = ImageFormat.PNG
+def _get_portrait_buffer(count: int, height: int, width: int) -> np.ndarray:
+    """Return an uninitialized (count, height, width, 4) array, reusing memory of the previous calls in this thread.
+
+    Atlases are cropped from the largest one, so the buffer is usually allocated only once per worker.
+    """
+    size = count * height * width * 4
+    buffer = getattr(_thread_buffers, 'portraits', None)
+    if buffer is None or buffer.size < size:
+        buffer = _thread_buffers.portraits = np.empty(size, dtype=np.uint8)
+    return buffer[:size].reshape(count, height, width, 4)
+
 
-    cmd_args = [x.lower() for x in sys.argv]
-    if '-png' in cmd_args:
-        image_format = ImageFormat.PNG
-    elif '-webp' in cmd_args:
-        image_format = ImageFormat.WEBP
+def _extract_sprites(atlas_np, rects, rotates, portraits):
+    """Copy sprites from the RGBA atlas array to the portraits array of shape (sprite_count, height, width, 4).
+
+    Each row of the rects table contains (x, y, width, height) of a sprite, Y coord is flipped.
+    Sprites of a different size are aligned to the bottom right corner of the portrait (size fix, just in case)
+    over a transparent (1, 1, 1, 0) background.
+    """
+    atlas_height = atlas_np.shape[0]
+    height, width = portraits.shape[1], portraits.shape[2]
+    for i in range(rects.shape[0]):
+        x, y, w, h = rects[i, 0], rects[i, 1], rects[i, 2], rects[i, 3]
+        y = atlas_height - (y + h)
+        sprite = atlas_np[y:y + h, x:x + w]
+        if rotates[i]:
+            sprite = np.transpose(sprite[::-1], (1, 0, 2))  # rotate clockwise, same as Image.ROTATE_270
+        dy = max(height - sprite.shape[0], 0)
+        dx = max(width - sprite.shape[1], 0)
+        # Only the margins around the sprite are filled with the background
+        portraits[i, :dy, :, :3] = 1
+        portraits[i, :dy, :, 3] = 0
+        portraits[i, dy:, :dx, :3] = 1
+        portraits[i, dy:, :dx, 3] = 0
+        portraits[i, dy:, dx:] = sprite[:height - dy, :width - dx]
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    """Parse command line arguments (`sys.argv` by default)."""
+    # Flags are case-insensitive
+    args = [arg.lower() if arg.startswith('-') else arg for arg in (sys.argv[1:] if args is None else args)]
+    parser = argparse.ArgumentParser(description='Crop portraits from portrait atlases exported by AssetStudio.',
+                                     allow_abbrev=False)
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument('-webp', dest='image_format', action='store_const', const=ImageFormat.WEBP,
+                              help='save portraits in webp format (default, lossless)')
+    format_group.add_argument('-png', dest='image_format', action='store_const', const=ImageFormat.PNG,
+                              help='save portraits in png format')
+    compression_group = parser.add_mutually_exclusive_group()
+    compression_group.add_argument('-fast', dest='compression', action='store_const', const=Compression.FAST,
+                                   help='encode portraits faster at the cost of their size (webp only)')
+    compression_group.add_argument('-small', dest='compression', action='store_const', const=Compression.SMALL,
+                                   help='make portraits smaller at the cost of processing time')
+    parser.add_argument('-lossy', action='store_true', help='save portraits in webp lossy format')
+    parser.set_defaults(image_format=ImageFormat.WEBP, compression=Compression.DEFAULT)
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    cmd_args = parse_args()
+    image_format = cmd_args.image_format
+    compression_mode = cmd_args.compression
+    is_lossy = cmd_args.lossy
 
     current_dir = os.path.dirname(os.path.abspath(__file__))
     date = datetime.date(datetime.now()).isoformat()
@@ -259,10 +465,17 @@ if __name__ == '__main__':
     output_dir = os.path.join(current_dir, '_output', date + output_format)
 
     portrait_hub_name = 'portrait_hub.json'
+    print(f'Using {get_pillow_backend()}.')
+    if cv2 and image_format == ImageFormat.PNG:
+        print(f'Using OpenCV {cv2.__version__} for PNG encoding.')
     try:
         portrait_hub = load_portrait_hub(input_json_path, portrait_hub_name)
-        processed_count = crop_multiprocessing(input_tex_path, output_dir, image_format, portrait_hub)
+        processed_count = crop_multiprocessing(input_tex_path, output_dir, image_format, portrait_hub,
+                                               compression_mode, is_lossy)
         print(f'Processed [{processed_count}/{portrait_hub["loaded_sprite_count"]}] portraits.')
+        if image_format == ImageFormat.PNG and compression_mode == Compression.SMALL:
+            if not optimize_png_output(output_dir):
+                print('[Warning] oxipng was not found, portraits were saved with maximum zlib compression instead.')
     except Exception:
         print(traceback.format_exc())
         input('\nPress ENTER to exit..')
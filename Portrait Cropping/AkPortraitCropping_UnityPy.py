@@ -1,20 +1,32 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 __author__ = 'aelurum'
-__version__ = "0.7b"
+__version__ = "0.8b"
 
+import argparse
 import concurrent.futures
 import os
+import shutil
+import subprocess
 import sys
+import threading
 import traceback
 from collections import defaultdict
 from datetime import datetime
 from enum import Enum, auto
 from io import BytesIO
+from multiprocessing import shared_memory
 from zipfile import ZipFile, is_zipfile, Path as ZipPath
 
+import PIL
 import UnityPy
-from PIL import Image
+import numpy as np
+from PIL import Image, features
+
+try:
+    import cv2
+except ModuleNotFoundError:
+    cv2 = None
 
 
 class SourceType(Enum):
@@ -27,6 +39,110 @@ class ImageFormat(Enum):
     WEBP = auto()
 
 
+class Compression(Enum):
+    FAST = auto()
+    DEFAULT = auto()
+    SMALL = auto()
+
+
+def get_pillow_backend() -> str:
+    """Return the name and version of the installed Pillow build and of the zlib library used by it.
+
+    Pillow-SIMD is a drop-in fork of Pillow and can only be distinguished by its version suffix (e.g. "9.0.0.post1").
+    zlib version is reported at runtime, so a zlib replacement loaded via LD_PRELOAD (e.g. "1.3.0.zlib-ng") is shown.
+    """
+    backend = 'Pillow-SIMD' if 'post' in PIL.__version__ else 'Pillow'
+    return f'{backend} {PIL.__version__} (zlib {features.version_codec("zlib")})'
+
+
+def get_cpu_count() -> int:
+    """Return the number of CPUs this process is allowed to run on (e.g. when limited by a container)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_save_options(img_format: ImageFormat, compression: Compression, lossy: bool = False) -> dict:
+    """Return keyword arguments for `Image.save()` for the specified output format and compression mode."""
+    save_options = {'format': img_format.name}
+    if img_format == ImageFormat.PNG:
+        # Fast deflate, small files are left to the oxipng post-pass (if it's available)
+        small_fallback = compression == Compression.SMALL and not shutil.which('oxipng')
+        save_options['compress_level'] = 9 if small_fallback else 1
+    elif img_format == ImageFormat.WEBP:
+        # Encoder effort: 0 - fastest, 6 - smallest files
+        method = {Compression.FAST: 0, Compression.DEFAULT: 4, Compression.SMALL: 6}[compression]
+        if lossy:
+            save_options.update({'lossless': False, 'method': method})
+            if compression == Compression.FAST:
+                save_options['quality'] = 85  # compensates for the size regression of the fastest method
+        else:
+            # In lossless mode quality is the compression effort. Maximum effort costs about twice the encoding time
+            # of 75 for ~3% smaller files, so it's used only on request. exact=True keeps RGB values of fully
+            # transparent pixels
+            effort = {Compression.FAST: 50, Compression.DEFAULT: 75, Compression.SMALL: 100}[compression]
+            save_options.update({'lossless': True, 'method': method, 'quality': effort, 'exact': True})
+    return save_options
+
+
+def optimize_png_output(out_dir: str) -> bool:
+    """Recompress PNG portraits in the specified folder using oxipng and return `False` if oxipng was not found."""
+    oxipng_path = shutil.which('oxipng')
+    if not oxipng_path:
+        return False
+
+    print('Optimizing portraits with oxipng..')
+    subprocess.run(
+        [oxipng_path, '--opt', '2', '--threads', str(get_cpu_count()), '--strip', 'safe', '--quiet',
+         '--recursive', out_dir],
+        check=True
+    )
+    return True
+
+
+_thread_buffers = threading.local()
+
+
+def get_image_saver(save_options: dict, dir_fd: int = None):
+    """Return a `save(image_np, path)` function that encodes an RGBA image array and writes it to the file.
+
+    Relative paths are resolved against the `dir_fd` directory descriptor, if it's specified.
+
+    The encoder is chosen once here instead of for every image. PNG images are encoded by OpenCV if it's installed,
+    other images are encoded by Pillow into a reusable per-thread buffer.
+    `save_options` must contain the image format, since it can't be guessed from a buffer.
+    """
+    if cv2 and save_options['format'] == 'PNG':
+        cv2_params = [cv2.IMWRITE_PNG_COMPRESSION, save_options['compress_level']]
+
+        def save(image_np: np.ndarray, path: str):
+            _, data = cv2.imencode('.png', cv2.cvtColor(image_np, cv2.COLOR_RGBA2BGRA), cv2_params)
+            _write_file(path, data.ravel(), dir_fd)
+    else:
+        def save(image_np: np.ndarray, path: str):
+            buffer = getattr(_thread_buffers, 'encode', None)
+            if buffer is None:
+                buffer = _thread_buffers.encode = BytesIO()
+            buffer.seek(0)
+            buffer.truncate()
+            Image.fromarray(image_np).save(buffer, **save_options)
+            with buffer.getbuffer() as data:
+                _write_file(path, data, dir_fd)
+
+    return save
+
+
+def _write_file(path: str, data, dir_fd: int = None):
+    """Write the bytes-like object to the file, replacing its contents."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666, dir_fd=dir_fd)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+    finally:
+        os.close(fd)
+
+
 class PortraitHub:
     """Represents a custom portrait hub with data needed for cropping, based on game's portrait hub and atlas assets.
 
@@ -48,22 +164,9 @@ class PortraitHub:
                 "alpha_path_id": int,
                 "texture_name": str,
                 "alpha_name": str,
-                "sprites": list[dict]
-                [
-                    {
-                        "name": str,
-                        "guid": str,
-                        "atlas": int,
-                        "rect": dict[str, int]
-                        {
-                            "x": int,
-                            "y": int,
-                            "w": int,
-                            "h": int
-                        },
-                        "rotate": int  # 0 or 1
-                    },
-                ]
+                "sprite_names": list[str],
+                "sprite_rects": np.ndarray,  # int32, shape (sprite_count, 4): x, y, w, h
+                "sprite_rotates": np.ndarray  # int32, shape (sprite_count,): 0 or 1
             },
         ]
     is_loaded : bool
@@ -71,8 +174,8 @@ class PortraitHub:
 
     Methods
     -------
-    crop_multithreaded(out_dir, img_format):
-        Crop sprites using threads and return total number of processed sprites.
+    crop_multithreaded(out_dir, img_format, compression, lossy):
+        Crop sprites in parallel and return total number of processed sprites.
     """
 
     def __init__(self, path: str):
@@ -164,13 +267,23 @@ class PortraitHub:
                     for sprite in sprite_list
                     if sprite['name'] in atlas_dict[atlas_index]
                 ]
+                # Sprites are ordered tile by tile (256x256 px), so that consecutive crops read nearby atlas memory
+                filtered_sprite_list.sort(key=lambda x: (x['rect']['y'] >> 8, x['rect']['x'] >> 8))
+                # Sprite data is stored as columns, so that it can be passed to the crop kernel as is
                 self.atlases.append(
                     {
                         'texture_name': atlas['_sign']['m_atlases'][0]['name'],
                         'alpha_name': atlas['_sign']['m_alphas'][0]['name'],
                         'texture_path_id': atlas['_atlas']['texture']['m_PathID'],
                         'alpha_path_id': atlas['_atlas']['alpha']['m_PathID'],
-                        'sprites': filtered_sprite_list,
+                        'sprite_names': [sprite['name'] for sprite in filtered_sprite_list],
+                        'sprite_rects': np.array(
+                            [tuple(sprite['rect'][key] for key in 'xywh') for sprite in filtered_sprite_list],
+                            dtype=np.int32
+                        ).reshape(-1, 4),
+                        'sprite_rotates': np.array(
+                            [sprite['rotate'] for sprite in filtered_sprite_list], dtype=np.int32
+                        ),
                     }
                 )
                 loaded_sprite_count += len(filtered_sprite_list)
@@ -210,8 +323,11 @@ class PortraitHub:
 
         return True
 
-    def crop_multithreaded(self, out_dir: str, img_format: ImageFormat) -> int:
-        """Crop sprites using threads and return total number of processed sprites.
+    def crop_multithreaded(self, out_dir: str, img_format: ImageFormat,
+                           compression: Compression = Compression.DEFAULT, lossy: bool = False) -> int:
+        """Crop sprites in parallel and return total number of processed sprites.
+
+        Atlases are cropped by a process pool, or by a thread pool on free-threaded Python builds with the GIL disabled.
 
         Parameters
         ----------
@@ -219,38 +335,64 @@ class PortraitHub:
             Path to the destination folder where portraits will be exported.
         img_format : ImageFormat
             Format of the output portrait images (.png/.webp).
+        compression : Compression
+            Compression mode of the output portrait images.
+        lossy : bool
+            Use lossy compression (.webp only).
         """
         if not self.is_loaded:
             print('[Error] Custom portrait hub was not loaded correctly.')
             return 0
 
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
+        os.makedirs(out_dir, exist_ok=True)
 
-        args = (
-            (atlas, img_format, out_dir)
-            for atlas in self.atlases
+        save_options = get_save_options(img_format, compression, lossy)
+        # Largest atlases go first, so that workers don't wait for a single big atlas at the end
+        atlases = sorted(self.atlases, key=lambda x: len(x['sprite_names']), reverse=True)
+
+        # Atlases can only be read from the unity environment of this process, so they are decoded here
+        # and handed to the workers. Processes get them via shared memory, threads can scale only without the GIL.
+        use_processes = is_gil_enabled()
+        executor_type = (
+            concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
         )
-        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-            futures = (executor.submit(self._crop, arg) for arg in args)
-            proc_count = sum(
-                future.result()
-                for future in concurrent.futures.as_completed(futures)
-            )
+        cpu_count = get_cpu_count()
+        max_workers = max(min(cpu_count, len(atlases)), 1)
+        # Encoding is CPU-bound too, so all workers together get one encoder thread per CPU
+        encoder_threads = max(cpu_count // max_workers, 1)
+        proc_count = 0
+        with executor_type(max_workers=max_workers) as executor:
+            futures = set()
+            for atlas in atlases:
+                atlas_np, shm = self._load_atlas(atlas, shared=use_processes)
+                if atlas_np is None:
+                    continue
+
+                atlas_data = (shm.name, atlas_np.shape, atlas_np.dtype.str) if shm else atlas_np
+                del atlas_np
+                future = executor.submit(
+                    _crop, (atlas, atlas_data, img_format, save_options, self.sprite_size, out_dir, encoder_threads)
+                )
+                if shm:
+                    future.add_done_callback(lambda _, shm_=shm: _release_shared_memory(shm_))
+                futures.add(future)
+
+                # One decoded atlas is kept ahead of the workers, so that a worker which finishes its atlas
+                # doesn't wait for the next one to be decoded. More of them would only take up memory
+                if len(futures) > max_workers:
+                    done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    proc_count += _report_results(done)
+            proc_count += _report_results(concurrent.futures.as_completed(futures))
 
         return proc_count
 
-    def _crop(self, args_tuple: tuple) -> int:
-        """Crop sprites from specified atlas and return processed sprite count."""
-        atlas: dict
-        img_format: ImageFormat
-        out_dir: str
-        if args_tuple and isinstance(args_tuple, tuple) and len(args_tuple) == 3:
-            atlas, img_format, out_dir = args_tuple
-        else:
-            arg_error = f'{"args type" if not isinstance(args_tuple, tuple) else "args length"}'
-            sys.exit(f'_crop(): [Error] Incorrect {arg_error}.')
+    def _load_atlas(self, atlas: dict, shared: bool = False):
+        """Read atlas and alpha images from the unity assets and return them as a single RGBA array.
 
+        If `shared` is set, the array is allocated in a new shared memory block, which is returned
+        together with the array. Otherwise the second item is `None`.
+        Return `(None, None)` if any of the images was not found.
+        """
         atlas_tex = None
         atlas_alpha = None
         for asset in self._unity_env.assets:
@@ -262,92 +404,216 @@ class PortraitHub:
                 break
         if not atlas_tex:
             print(f'[Warning] Atlas image "{atlas["texture_name"]}" was not found.')
-            return 0
+            return None, None
         if not atlas_alpha:
             print(f'[Warning] Alpha image "{atlas["alpha_name"]}" was not found.')
-            return 0
-
-        atlas_alpha = atlas_alpha.convert(mode='L')
-        if atlas_alpha.size != atlas_tex.size:
-            atlas_alpha = atlas_alpha.resize(size=atlas_tex.size, resample=Image.BICUBIC)
-        atlas_tex.putalpha(atlas_alpha)
+            return None, None
+
+        # Conversions are skipped for images that are already in a suitable mode
+        if atlas_alpha.mode != 'L':
+            atlas_alpha = atlas_alpha.convert(mode='L')
+        alpha_factor = atlas_alpha.width // atlas_tex.width
+        if alpha_factor > 1 and atlas_alpha.size == (atlas_tex.width * alpha_factor, atlas_tex.height * alpha_factor):
+            # Integer downscale, box filter of reduce() is much cheaper than a resampling convolution
+            atlas_alpha = atlas_alpha.reduce(alpha_factor)
+        elif atlas_alpha.size != atlas_tex.size:
+            # Bicubic filter gives no visible benefit on a mask
+            atlas_alpha = atlas_alpha.resize(size=atlas_tex.size, resample=Image.BILINEAR)
+        if atlas_tex.mode not in ('RGB', 'RGBA'):
+            atlas_tex = atlas_tex.convert(mode='RGB')
+        # RGB + alpha channels in one (height, width, 4) array, filled in place to avoid intermediate copies
+        shape = (atlas_tex.height, atlas_tex.width, 4)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape))) if shared else None
+        atlas_np = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf if shm else None)
+        atlas_np[:, :, :3] = np.asarray(atlas_tex)[:, :, :3]
+        atlas_np[:, :, 3] = np.asarray(atlas_alpha)
         atlas_alpha.close()
+        atlas_tex.close()
 
-        proc_count = 0
-        for sprite in atlas['sprites']:
-            sprite_name = sprite['name']
-            rect = sprite['rect']
-            rotate = sprite['rotate']
-
-            # Uses flipped Y coord
-            portrait = atlas_tex.crop(
-                box=(
-                    rect['x'],  # x
-                    atlas_tex.height - (rect['y'] + rect['h']),  # y
-                    rect['x'] + rect['w'],  # width
-                    atlas_tex.height - rect['y']  # height
-                )
+        return atlas_np, shm
+
+
+def is_gil_enabled() -> bool:
+    """Return `False` if running on a free-threaded build of CPython (3.13t+) with the GIL disabled."""
+    gil_check = getattr(sys, '_is_gil_enabled', None)
+    return gil_check() if gil_check else True
+
+
+def _release_shared_memory(shm: shared_memory.SharedMemory):
+    """Close and free the shared memory block."""
+    shm.close()
+    shm.unlink()
+
+
+def _report_results(futures) -> int:
+    """Print names of the atlases cropped by the finished `_crop` futures and return their total sprite count.
+
+    Progress is printed by the main process only, so that workers don't compete for stdout.
+    """
+    proc_count = 0
+    for future in futures:
+        atlas_name, atlas_proc_count = future.result()
+        print(f'Processed "{atlas_name}" atlas.')
+        proc_count += atlas_proc_count
+    return proc_count
+
+
+def _crop(args_tuple: tuple) -> tuple:
+    """Crop sprites from specified atlas and return its name and processed sprite count.
+
+    Atlas image data is either a numpy array or a (name, shape, dtype) descriptor of an array in shared memory.
+    """
+    atlas: dict
+    atlas_data: object
+    img_format: ImageFormat
+    save_options: dict
+    sprite_size: tuple
+    out_dir: str
+    encoder_threads: int
+    if args_tuple and isinstance(args_tuple, tuple) and len(args_tuple) == 7:
+        atlas, atlas_data, img_format, save_options, sprite_size, out_dir, encoder_threads = args_tuple
+    else:
+        arg_error = f'{"args type" if not isinstance(args_tuple, tuple) else "args length"}'
+        sys.exit(f'_crop(): [Error] Incorrect {arg_error}.')
+
+    if isinstance(atlas_data, tuple):
+        shm_name, shape, dtype = atlas_data
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            proc_count = _crop_sprites(
+                atlas, np.ndarray(shape, dtype=dtype, buffer=shm.buf), img_format, save_options, sprite_size, out_dir,
+                encoder_threads
             )
-            if rotate:
-                portrait = portrait.transpose(method=Image.ROTATE_270)
-            if rect['w'] not in self.sprite_size or rect['h'] not in self.sprite_size:  # size fix (just in case)
-                temp = Image.new(mode='RGBA', size=self.sprite_size, color=(1, 1, 1, 0))
-                temp.alpha_composite(
-                    im=portrait,
-                    dest=(
-                        max(self.sprite_size[0] - portrait.width, 0),
-                        max(self.sprite_size[1] - portrait.height, 0)
-                    )
-                )
-                portrait = temp
-
-            output_path = os.path.join(out_dir, f'{sprite_name}.{img_format.name.lower()}')
-            save_options = {'format': img_format.name}
-            if img_format == ImageFormat.PNG:
-                save_options['compress_level'] = 7
-            elif img_format == ImageFormat.WEBP:
-                save_options['lossless'] = False
-            portrait.save(output_path, **save_options)
-            proc_count += 1
-        atlas_tex.close()
-        print(f'Processed "{atlas["texture_name"]}" atlas.\n', end='')  # fix for "parallel" processing
+        finally:
+            shm.close()
+    else:
+        proc_count = _crop_sprites(atlas, atlas_data, img_format, save_options, sprite_size, out_dir, encoder_threads)
+
+    return atlas['texture_name'], proc_count
+
+
+def _crop_sprites(atlas: dict, atlas_np, img_format: ImageFormat, save_options: dict, sprite_size: tuple,
+                  out_dir: str, encoder_threads: int = 1) -> int:
+    """Crop and save sprites of the atlas from its RGBA array and return processed sprite count."""
+    portraits = _get_portrait_buffer(len(atlas['sprite_names']), sprite_size[1], sprite_size[0])
+    _extract_sprites(atlas_np, atlas['sprite_rects'], atlas['sprite_rotates'], portraits)
+
+    proc_count = 0
+    ext = f'.{img_format.name.lower()}'
+    # Where supported (posix), files are created relative to the opened output folder,
+    # so that the folder path isn't resolved again for every file
+    if os.open in os.supports_dir_fd:
+        dir_fd = os.open(out_dir, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        out_prefix = ''
+    else:
+        dir_fd = None
+        out_prefix = os.path.join(out_dir, '')
+    save_image = get_image_saver(save_options, dir_fd)
+    try:
+        # Images are encoded and saved by a thread pool (encoders release the GIL)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=encoder_threads) as encoder:
+            futures = [
+                encoder.submit(save_image, portrait_np, out_prefix + sprite_name + ext)
+                for sprite_name, portrait_np in zip(atlas['sprite_names'], portraits)
+            ]
+            for future in futures:
+                future.result()
+                proc_count += 1
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+    return proc_count
 
-        return proc_count
+
+def _get_portrait_buffer(count: int, height: int, width: int) -> np.ndarray:
+    """Return an uninitialized (count, height, width, 4) array, reusing memory of the previous calls in this thread.
+
+    Atlases are cropped from the largest one, so the buffer is usually allocated only once per worker.
+    """
+    size = count * height * width * 4
+    buffer = getattr(_thread_buffers, 'portraits', None)
+    if buffer is None or buffer.size < size:
+        buffer = _thread_buffers.portraits = np.empty(size, dtype=np.uint8)
+    return buffer[:size].reshape(count, height, width, 4)
+
+
+def _extract_sprites(atlas_np, rects, rotates, portraits):
+    """Copy sprites from the RGBA atlas array to the portraits array of shape (sprite_count, height, width, 4).
+
+    Each row of the rects table contains (x, y, width, height) of a sprite, Y coord is flipped.
+    Sprites of a different size are aligned to the bottom right corner of the portrait (size fix, just in case)
+    over a transparent (1, 1, 1, 0) background.
+    """
+    atlas_height = atlas_np.shape[0]
+    height, width = portraits.shape[1], portraits.shape[2]
+    for i in range(rects.shape[0]):
+        x, y, w, h = rects[i, 0], rects[i, 1], rects[i, 2], rects[i, 3]
+        y = atlas_height - (y + h)
+        sprite = atlas_np[y:y + h, x:x + w]
+        if rotates[i]:
+            sprite = np.transpose(sprite[::-1], (1, 0, 2))  # rotate clockwise, same as Image.ROTATE_270
+        dy = max(height - sprite.shape[0], 0)
+        dx = max(width - sprite.shape[1], 0)
+        # Only the margins around the sprite are filled with the background
+        portraits[i, :dy, :, :3] = 1
+        portraits[i, :dy, :, 3] = 0
+        portraits[i, dy:, :dx, :3] = 1
+        portraits[i, dy:, :dx, 3] = 0
+        portraits[i, dy:, dx:] = sprite[:height - dy, :width - dx]
+
+
+def parse_args(args: list = None) -> argparse.Namespace:
+    """Parse command line arguments (`sys.argv` by default)."""
+    # Flags are case-insensitive
+    args = [arg.lower() if arg.startswith('-') else arg for arg in (sys.argv[1:] if args is None else args)]
+    parser = argparse.ArgumentParser(description='Crop portraits from portrait atlases of the game.',
+                                     allow_abbrev=False)
+    parser.add_argument('input_path', nargs='?', default='',
+                        help='path to the game`s .apk file or to the "charportraits" folder')
+    format_group = parser.add_mutually_exclusive_group()
+    format_group.add_argument('-webp', dest='image_format', action='store_const', const=ImageFormat.WEBP,
+                              help='save portraits in webp format (default, lossless)')
+    format_group.add_argument('-png', dest='image_format', action='store_const', const=ImageFormat.PNG,
+                              help='save portraits in png format')
+    compression_group = parser.add_mutually_exclusive_group()
+    compression_group.add_argument('-fast', dest='compression', action='store_const', const=Compression.FAST,
+                                   help='encode portraits faster at the cost of their size (webp only)')
+    compression_group.add_argument('-small', dest='compression', action='store_const', const=Compression.SMALL,
+                                   help='make portraits smaller at the cost of processing time')
+    parser.add_argument('-lossy', action='store_true', help='save portraits in webp lossy format')
+    parser.set_defaults(image_format=ImageFormat.WEBP, compression=Compression.DEFAULT)
+    return parser.parse_args(args)
 
 
 if __name__ == '__main__':
-    image_format = ImageFormat.PNG
-
-    for i, val in enumerate(sys.argv):
-        if val.lower() == '-png':
-            image_format = ImageFormat.PNG
-            _ = sys.argv.pop(i)
-            break
-        if val.lower() == '-webp':
-            image_format = ImageFormat.WEBP
-            _ = sys.argv.pop(i)
-            break
+    cmd_args = parse_args()
+    image_format = cmd_args.image_format
+    compression_mode = cmd_args.compression
+    is_lossy = cmd_args.lossy
 
     current_dir = os.path.dirname(os.path.abspath(__file__))
     date = datetime.date(datetime.now()).isoformat()
     output_format = f'-{image_format.name.lower()}'
     output_dir = os.path.join(current_dir, '_output', date + output_format)
 
-    input_path = ''
-    if len(sys.argv) == 2:
-        input_path = sys.argv[1]
-    elif len(sys.argv) > 2:
-        sys.exit('[Error] Too many arguments. Or unsupported image_format value.')
-    elif len(sys.argv) == 1:
+    input_path = cmd_args.input_path
+    if not input_path:
         input_path = input('Please enter a path to the game`s .apk file or to the "charportraits" folder '
                            'containing portrait asset files (portrait_hub.ab, pack[x].ab):\n')
     if not input_path:
         sys.exit('No input files.')
 
+    print(f'Using {get_pillow_backend()}.')
+    if cv2 and image_format == ImageFormat.PNG:
+        print(f'Using OpenCV {cv2.__version__} for PNG encoding.')
     try:
         portrait_hub = PortraitHub(input_path)
-        processed_count = portrait_hub.crop_multithreaded(output_dir, image_format)
+        processed_count = portrait_hub.crop_multithreaded(output_dir, image_format, compression_mode, is_lossy)
         print(f'Processed [{processed_count}/{portrait_hub.loaded_sprite_count}] portraits.')
+        if image_format == ImageFormat.PNG and compression_mode == Compression.SMALL:
+            if not optimize_png_output(output_dir):
+                print('[Warning] oxipng was not found, portraits were saved with maximum zlib compression instead.')
     except Exception:
         print(traceback.format_exc())
         input('\nPress ENTER to exit..')